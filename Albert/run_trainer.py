@@ -227,27 +227,18 @@ def main():
         announce_maddrs=collaboration_args.announce_maddrs,
         identity_path=collaboration_args.identity_path,
     )
-    log_visible_maddrs(dht.get_visible_maddrs(), only_p2p=collaboration_args.use_ipfs)
+    # Get the visible multiaddresses once and reuse them below
+    visible_maddrs = dht.get_visible_maddrs()
+    log_visible_maddrs(visible_maddrs, only_p2p=collaboration_args.use_ipfs)
 
 
     from pyngrok import ngrok
-    
-    import re
-    # Get the visible multiaddresses directly
-    visible_maddrs = dht.get_visible_maddrs()
-    print(visible_maddrs)
+    from pyngrok.conf import PyngrokConfig
 
-    # Regular expression to match port number in the Multiaddr format
-    port_pattern = r"tcp/(\d+)"
+    print(visible_maddrs)
 
     # Extract port numbers
-    ports = []
-    for addr in visible_maddrs:
-        # Convert Multiaddr object to string and apply regex
-        addr_str = str(addr)  # Convert Multiaddr object to a string
-        match = re.search(port_pattern, addr_str)
-        if match:
-            ports.append(int(match.group(1)))
+    ports = utils.get_tcp_ports(visible_maddrs)
 
     # Print the extracted ports
     print(ports)
@@ -257,7 +248,9 @@ def main():
     dht_port = ports[0]  # 假设 DHT 类有一个 `port` 属性，表示 DHT 服务的端口号
 
     # 启动 ngrok 隧道，将端口暴露到外部
-    ngrok_tunnel = ngrok.connect(dht_port, "tcp")
+    # ngrok 进程由 pyngrok 管理，其日志写入 logger
+    pyngrok_config = PyngrokConfig(log_event_callback=lambda log: logger.info(log.line))
+    ngrok_tunnel = ngrok.connect(dht_port, "tcp", pyngrok_config=pyngrok_config)
     public_url = ngrok_tunnel.public_url
 
     # 打印 Ngrok 隧道的公共 URL
@@ -274,12 +267,6 @@ def main():
     # 打印 Ngrok 公共地址
     logger.info(f"DHT is now accessible via: {public_url}")
 
-    # 在后台启动 ngrok 进程并输出日志
-    ngrok_command = f"nohup ./ngrok tcp {dht_port} > ngrok.log 2>&1 &"
-
-    import subprocess
-    subprocess.run(ngrok_command, shell=True)
-
 
     total_batch_size_per_step = training_args.per_device_train_batch_size * training_args.gradient_accumulation_steps
     if torch.cuda.device_count() != 0:
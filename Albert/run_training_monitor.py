@@ -1,15 +1,20 @@
 #!/usr/bin/env python3
 
+import math
+import os
+import shutil
+import tempfile
 import time
-from dataclasses import asdict, dataclass, field
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
 from ipaddress import ip_address
 from typing import Optional
 
+import numpy as np
 import requests
 import torch
-import wandb
-from torch_optimizer import Lamb
-from transformers import AlbertConfig, AlbertForPreTraining, HfArgumentParser, get_linear_schedule_with_warmup
+from safetensors.torch import load_file, save_file
+from transformers import HfArgumentParser
 
 import hivemind
 from hivemind.optim.state_averager import TrainingStateAverager
@@ -22,6 +27,80 @@ from arguments import AveragerArguments, BaseTrainingArguments, OptimizerArgumen
 use_hivemind_log_handler("in_root_logger")
 logger = get_logger(__name__)
 
+HTTP_TIMEOUT = 30.0
+# Optimizer snapshots are written to tmpfs (if available) before being uploaded in background
+SNAPSHOT_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+NO_DECAY_PARAMETERS = frozenset(["bias", "LayerNorm.weight"])
+
+
+def _cast_state_dict_bf16(state_dict: dict) -> dict:
+    """
+    Casts float32 tensors of an optimizer state dict to bfloat16. Unlike float16, bfloat16 has the exponent range
+    of float32, so small second moments do not underflow to zero and large norms do not overflow
+    """
+
+    def _cast(value):
+        if isinstance(value, torch.Tensor) and value.dtype == torch.float32:
+            return value.to(torch.bfloat16)
+        elif isinstance(value, dict):
+            return {key: _cast(item) for key, item in value.items()}
+        return value
+
+    return _cast(state_dict)
+
+
+def _save_optimizer_state(state_dict: dict, directory: str):
+    """
+    Saves the optimizer state dict as a few large safetensors buffers and a small torch.save file with the rest.
+    Per-parameter state tensors are concatenated into one flat buffer per param group, state key and dtype
+    (in the order of group["params"]); "state_layout" maps each of them to its buffer and shape.
+    Use _load_optimizer_state to read the result back.
+    """
+    tensors, param_states, state_layout = {}, {}, {}
+    for group_index, group in enumerate(state_dict["param_groups"]):
+        flat_parts = {}
+        for param_id in group["params"]:
+            param_states[param_id], state_layout[param_id] = {}, {}
+            for key, value in state_dict["state"].get(param_id, {}).items():
+                if isinstance(value, torch.Tensor):
+                    dtype_name = str(value.dtype).replace("torch.", "")
+                    buffer_name = f"param_groups.{group_index}.{key}.{dtype_name}"
+                    flat_parts.setdefault(buffer_name, []).append(value.reshape(-1))
+                    state_layout[param_id][key] = (buffer_name, tuple(value.shape))
+                else:
+                    param_states[param_id][key] = value
+
+        for buffer_name, parts in flat_parts.items():
+            tensors[buffer_name] = torch.cat(parts)
+
+    save_file(tensors, os.path.join(directory, "optimizer_state.safetensors"))
+    metadata = dict(state_dict, state=param_states, state_layout=state_layout)
+    torch.save(metadata, os.path.join(directory, "optimizer_metadata.pt"))
+
+
+def _load_optimizer_state(directory: str) -> dict:
+    """
+    Reads an optimizer state dict saved by _save_optimizer_state, suitable for optimizer.load_state_dict.
+    Tensors stored in bfloat16 (see _cast_state_dict_bf16) are converted back to float32
+    """
+    tensors = load_file(os.path.join(directory, "optimizer_state.safetensors"))
+    metadata = torch.load(os.path.join(directory, "optimizer_metadata.pt"))
+    state_layout = metadata.pop("state_layout")
+
+    state, offsets = {}, {}
+    for group in metadata["param_groups"]:
+        for param_id in group["params"]:
+            param_state = dict(metadata["state"][param_id])
+            for key, (buffer_name, shape) in state_layout[param_id].items():
+                start, numel = offsets.get(buffer_name, 0), math.prod(shape)
+                value = tensors[buffer_name][start : start + numel].view(shape)
+                offsets[buffer_name] = start + numel
+                param_state[key] = value.float() if value.dtype == torch.bfloat16 else value.clone()
+            if param_state:
+                state[param_id] = param_state
+
+    return dict(metadata, state=state)
+
 
 @dataclass
 class TrainingMonitorArguments(BaseTrainingArguments):
@@ -38,6 +117,10 @@ class TrainingMonitorArguments(BaseTrainingArguments):
         },
     )
     refresh_period: float = field(default=30, metadata={"help": "Period (in seconds) for fetching the keys from DHT"})
+    max_refresh_period: float = field(
+        default=300,
+        metadata={"help": "The refresh period doubles up to this many seconds while the DHT reports no new steps"},
+    )
     wandb_project: Optional[str] = field(
         default=None, metadata={"help": "Name of Weights & Biases project to report the training progress to"}
     )
@@ -74,19 +157,31 @@ class CheckpointHandler:
         self.upload_interval = monitor_args.upload_interval
         self.previous_step = -1
 
-        config = AlbertConfig.from_pretrained(monitor_args.model_config_path)
-        self.model = AlbertForPreTraining(config)
+        # Model and optimizer modules are only needed when storing checkpoints, so they are imported lazily
+        from torch_optimizer import Lamb
+        from transformers import AlbertConfig, AlbertForPreTraining, get_linear_schedule_with_warmup
 
-        no_decay = ["bias", "LayerNorm.weight"]
+        config = AlbertConfig.from_pretrained(monitor_args.model_config_path)
+        if self.repo_path is not None:
+            self.model = AlbertForPreTraining(config)
+            named_parameters = list(self.model.named_parameters())
+        else:
+            # Without uploads, the model is never used: only tensors of matching shapes are needed to hold the state
+            # loaded from peers, so we skip weight initialization by building the model on the meta device
+            self.model = None
+            with torch.device("meta"):
+                meta_model = AlbertForPreTraining(config)
+            named_parameters = [
+                (n, torch.nn.Parameter(torch.zeros(p.shape, dtype=p.dtype))) for n, p in meta_model.named_parameters()
+            ]
+            del meta_model
+
+        decay, no_decay = [], []
+        for n, p in named_parameters:
+            (no_decay if any(nd in n for nd in NO_DECAY_PARAMETERS) else decay).append(p)
         optimizer_grouped_parameters = [
-            {
-                "params": [p for n, p in self.model.named_parameters() if not any(nd in n for nd in no_decay)],
-                "weight_decay": 0.01,
-            },
-            {
-                "params": [p for n, p in self.model.named_parameters() if any(nd in n for nd in no_decay)],
-                "weight_decay": 0.0,
-            },
+            {"params": decay, "weight_decay": 0.01},
+            {"params": no_decay, "weight_decay": 0.0},
         ]
 
         opt = Lamb(
@@ -97,22 +192,35 @@ class CheckpointHandler:
             debias=True,
         )
 
+        # unlike asdict, this does not deep-copy the field values
+        averager_kwargs = {f.name: getattr(averager_args, f.name) for f in fields(averager_args)}
         self.state_averager = TrainingStateAverager(
             dht=dht,
             optimizer=opt,
             scheduler=get_linear_schedule_with_warmup(opt, num_warmup_steps=5000, num_training_steps=125_000),
             prefix=f"{run_id}_state_averager",
+            # state_compression only applies to the state served to joining peers (not to averaging rounds),
+            # so 8-bit quantization would not speed anything up and would hand them lossy parameters and statistics
             state_compression=hivemind.Float16Compression(),
             bandwidth=optimizer_args.bandwidth,
             client_mode=optimizer_args.client_mode,
             start=True,
-            **asdict(averager_args),
+            **averager_kwargs,
         )
-        self.previous_timestamp = time.time()
+        self.previous_timestamp = time.monotonic()
+
+        self._upload_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_upload: Optional[Future] = None
+
+    def is_upload_in_progress(self):
+        return self._pending_upload is not None and not self._pending_upload.done()
 
     def is_time_to_save_state(self, cur_step):
         if self.save_checkpoint_step_interval is None:
             return False
+        elif self.is_upload_in_progress():
+            # loading the state from peers would overwrite the model while it is being uploaded
+            return False
         elif cur_step - self.previous_step >= self.save_checkpoint_step_interval:
             return True
         else:
@@ -126,22 +234,63 @@ class CheckpointHandler:
     def is_time_to_upload(self):
         if self.repo_path is None:
             return False
-        elif time.time() - self.previous_timestamp >= self.upload_interval:
+        elif self.is_upload_in_progress():
+            return False
+        elif time.monotonic() - self.previous_timestamp >= self.upload_interval:
             return True
         else:
             return False
 
     def upload_checkpoint(self, current_loss):
+        if self._pending_upload is not None:
+            self._pending_upload.result()
+
         logger.info("Saving optimizer")
-        torch.save(self.state_averager.optimizer.state_dict(), f"{self.repo_path}/optimizer_state.pt")
-        self.previous_timestamp = time.time()
-        logger.info("Started uploading to Model Hub")
-        self.model.push_to_hub(
-            repo_name=self.repo_path,
-            repo_url=self.repo_url,
-            commit_message=f"Step #{current_step}, loss {current_loss:.3f}",
+        optimizer_state = _cast_state_dict_bf16(self.state_averager.optimizer.state_dict())
+        snapshot_dir = self._save_snapshot(optimizer_state)
+        if snapshot_dir is None:
+            logger.warning("Could not save the optimizer snapshot, skipping this upload")
+            return
+        self.previous_timestamp = time.monotonic()
+        self._pending_upload = self._upload_executor.submit(
+            self._do_upload, snapshot_dir, self.previous_step, current_loss
         )
-        logger.info("Finished uploading to Model Hub")
+
+    def _save_snapshot(self, optimizer_state) -> Optional[str]:
+        # tmpfs may be too small for the snapshot (e.g., Docker limits /dev/shm to 64 MB by default),
+        # in that case we fall back to a temporary directory under repo_path
+        for parent_dir in (SNAPSHOT_DIR, self.repo_path):
+            snapshot_dir = None
+            try:
+                snapshot_dir = tempfile.mkdtemp(prefix="optimizer_snapshot_", dir=parent_dir)
+                _save_optimizer_state(optimizer_state, snapshot_dir)
+                return snapshot_dir
+            except Exception:
+                logger.exception(f"Failed to save the optimizer snapshot to {snapshot_dir or parent_dir}")
+                if snapshot_dir is not None:
+                    shutil.rmtree(snapshot_dir, ignore_errors=True)
+        return None
+
+    def _do_upload(self, snapshot_dir, step, current_loss):
+        try:
+            for filename in os.listdir(snapshot_dir):
+                shutil.move(os.path.join(snapshot_dir, filename), os.path.join(self.repo_path, filename))
+            # older checkpoints stored the optimizer as a single file, do not push it next to the new weights
+            legacy_optimizer_path = os.path.join(self.repo_path, "optimizer_state.pt")
+            if os.path.exists(legacy_optimizer_path):
+                logger.info(f"Removing outdated {legacy_optimizer_path}")
+                os.remove(legacy_optimizer_path)
+            logger.info("Started uploading to Model Hub")
+            self.model.push_to_hub(
+                repo_name=self.repo_path,
+                repo_url=self.repo_url,
+                commit_message=f"Step #{step}, loss {current_loss:.3f}",
+            )
+            logger.info("Finished uploading to Model Hub")
+        except Exception:
+            logger.exception("Failed to upload the checkpoint to Model Hub")
+        finally:
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
@@ -152,7 +301,7 @@ if __name__ == "__main__":
     
 
     if monitor_args.use_google_dns:
-        request = requests.get("https://api.ipify.org")
+        request = requests.get("https://api.ipify.org", timeout=HTTP_TIMEOUT)
         request.raise_for_status()
 
         address = request.text
@@ -173,6 +322,7 @@ if __name__ == "__main__":
 
 
     from pyngrok import ngrok  # 安装 pyngrok: pip install pyngrok
+    from pyngrok.conf import PyngrokConfig
 
     # # 在 DHT 初始化之前，创建 ngrok 隧道
     # dht_port = 43339  # 替换为你希望的 DHT 端口
@@ -204,22 +354,12 @@ if __name__ == "__main__":
     #     record_validators=validators,
     # )
 
-    import re
     # Get the visible multiaddresses directly
     visible_maddrs = dht.get_visible_maddrs()
     print(visible_maddrs)
 
-    # Regular expression to match port number in the Multiaddr format
-    port_pattern = r"tcp/(\d+)"
-
     # Extract port numbers
-    ports = []
-    for addr in visible_maddrs:
-        # Convert Multiaddr object to string and apply regex
-        addr_str = str(addr)  # Convert Multiaddr object to a string
-        match = re.search(port_pattern, addr_str)
-        if match:
-            ports.append(int(match.group(1)))
+    ports = utils.get_tcp_ports(visible_maddrs)
 
     # Print the extracted ports
     print(ports)
@@ -229,7 +369,9 @@ if __name__ == "__main__":
     dht_port = ports[0]  # 假设 DHT 类有一个 `port` 属性，表示 DHT 服务的端口号
 
     # 启动 ngrok 隧道，将端口暴露到外部
-    ngrok_tunnel = ngrok.connect(dht_port, "tcp")
+    # ngrok 进程由 pyngrok 管理，其日志写入 logger
+    pyngrok_config = PyngrokConfig(log_event_callback=lambda log: logger.info(log.line))
+    ngrok_tunnel = ngrok.connect(dht_port, "tcp", pyngrok_config=pyngrok_config)
     public_url = ngrok_tunnel.public_url
 
     # 打印 Ngrok 隧道的公共 URL
@@ -241,21 +383,17 @@ if __name__ == "__main__":
     print(f"After: {monitor_args.announce_maddrs}")
 
     # 显示可见的多重地址
-    log_visible_maddrs(dht.get_visible_maddrs(), only_p2p=monitor_args.use_ipfs)
+    log_visible_maddrs(visible_maddrs, only_p2p=monitor_args.use_ipfs)
 
     # 打印 Ngrok 公共地址
     logger.info(f"DHT is now accessible via: {public_url}")
 
-    # 在后台启动 ngrok 进程并输出日志
-    ngrok_command = f"nohup ./ngrok tcp {dht_port} > ngrok.log 2>&1 &"
-
-    import subprocess
-    subprocess.run(ngrok_command, shell=True)
-
 
 
 
     if monitor_args.wandb_project is not None:
+        import wandb
+
         wandb.init(project=monitor_args.wandb_project)
 
     current_step = 0
@@ -264,38 +402,51 @@ if __name__ == "__main__":
 
     # checkpoint_handler = CheckpointHandler(monitor_args, optimizer_args, averager_args, dht)
 
+    same_step_count = 0
+    # Backoff never polls more often than --refresh_period, even if it exceeds the default --max_refresh_period
+    max_refresh_period = max(monitor_args.max_refresh_period, monitor_args.refresh_period)
+    num_polls = num_new_steps = 0
+
     time_x = 0
     # while True:
     while time_x<3:
         print(f"While True:{time_x}")
+        fetch_started = time.monotonic()
         metrics_dict = dht.get(run_id + "_metrics", latest=True)
+        dht_rtt = time.monotonic() - fetch_started
         print(f"metrics_dict = {metrics_dict}")
+        num_polls += 1
+        new_step = False
         if metrics_dict is not None:
             metrics_dict = metrics_dict.value
-            metrics = [utils.LocalMetrics.parse_obj(metrics_dict[peer].value) for peer in metrics_dict]
-            latest_step = max(item.step for item in metrics)
+            metrics = [utils.LocalMetrics.parse_obj(entry.value) for entry in metrics_dict.values()]
+            steps = np.fromiter((item.step for item in metrics), dtype=np.int64, count=len(metrics))
+            latest_step = int(steps.max())
 
             if latest_step != current_step:
+                new_step = True
+                num_new_steps += 1
                 logger.debug(f"Got metrics from {len(metrics)} peers")
 
                 for i, metrics_for_peer in enumerate(metrics):
                     logger.debug(f"{i} peer {metrics_for_peer}")
 
                 current_step = latest_step
-                alive_peers = 0
-                sum_loss = 0
-                num_samples = 0
-                sum_perf = 0
-                sum_mini_steps = 0
-
-                for item in metrics:
-                    sum_loss += item.loss
-                    alive_peers += 1
-                    sum_perf += item.samples_per_second
-                    num_samples += item.samples_accumulated
-                    sum_mini_steps += item.mini_steps
+                # Fields are still gathered peer by peer, but all four sums are then computed in a single reduction
+                metrics_array = np.array(
+                    [
+                        (item.loss, item.samples_per_second, item.samples_accumulated, item.mini_steps)
+                        for item in metrics
+                    ],
+                    dtype=np.float64,
+                )
+                alive_peers = len(metrics)
+                sum_loss, sum_perf, num_samples, sum_mini_steps = metrics_array.sum(axis=0).tolist()
+                num_samples, sum_mini_steps = int(num_samples), int(sum_mini_steps)
                 current_loss = sum_loss / sum_mini_steps
+                convergence_ratio = num_new_steps / num_polls
                 logger.info(f"Step #{current_step}\tloss = {current_loss:.5f}")
+                logger.debug(f"{convergence_ratio:.2f} of DHT fetches returned a new step")
 
                 if monitor_args.wandb_project is not None:
                     wandb.log(
@@ -305,6 +456,7 @@ if __name__ == "__main__":
                             "samples": num_samples,
                             "performance": sum_perf,
                             "step": latest_step,
+                            "convergence ratio": convergence_ratio,
                         }
                     )
 
@@ -317,5 +469,14 @@ if __name__ == "__main__":
                         if checkpoint_handler.is_time_to_upload():
                             checkpoint_handler.upload_checkpoint(current_loss)
         logger.debug("Peer is still alive...")
-        time.sleep(monitor_args.refresh_period)
+        # Poll less often while the collaboration does not make progress, reset as soon as a new step appears
+        if new_step:
+            same_step_count = 0
+        elif monitor_args.refresh_period * 2**same_step_count < max_refresh_period:
+            same_step_count += 1
+        refresh_period = min(monitor_args.refresh_period * 2**same_step_count, max_refresh_period)
+
+        # The DHT get above is synchronous, so we subtract its duration from the sleep
+        # to keep the period between fetches close to refresh_period
+        time.sleep(max(refresh_period - dht_rtt, 0.0))
         time_x += 1
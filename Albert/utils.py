@@ -1,4 +1,4 @@
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, List, Tuple
 
 from pydantic.v1 import BaseModel, StrictFloat, confloat, conint
 
@@ -26,3 +26,12 @@ def make_validators(run_id: str) -> Tuple[List[RecordValidatorBase], bytes]:
     signature_validator = RSASignatureValidator()
     validators = [SchemaValidator(MetricSchema, prefix=run_id), signature_validator]
     return validators, signature_validator.local_public_key
+
+
+def get_tcp_ports(maddrs: Iterable) -> List[int]:
+    """Returns TCP ports of the given multiaddrs, skipping the ones that do not use TCP"""
+    return [
+        int(maddr.value_for_protocol("tcp"))
+        for maddr in maddrs
+        if any(protocol.name == "tcp" for protocol in maddr.protocols())
+    ]